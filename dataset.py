@@ -1,11 +1,34 @@
-from typing import List, Tuple, Union
+import hashlib
+import json
+import os
+from itertools import chain
+from typing import Iterator, List, Optional, Tuple, Union
 
 import numpy as np
 import torch
-from torch.utils.data import Dataset
+import torch.nn.functional as F
+from torch.nn.utils.rnn import pad_sequence
+from torch.utils.data import Dataset, Sampler
 from tqdm import tqdm
 
 from language import Language
+from utils import infer_length
+
+
+def get_token_dtype(language: Language) -> np.dtype:
+    """
+    Get the smallest dtype to store token ids: uint16 if possible, else int32.
+    """
+
+    max_id = max(
+        max(language.word2idx.values(), default=0),
+        language.unk_id,
+        language.bos_id,
+        language.eos_id,
+    )
+    if max_id <= np.iinfo(np.uint16).max:
+        return np.dtype(np.uint16)
+    return np.dtype(np.int32)
 
 
 def load_data(
@@ -13,30 +36,130 @@ def load_data(
     language: Language,
     add_bos: bool = False,
     add_eos: bool = False,
+    chunk_size: int = 10_000,
+    num_threads: Optional[int] = None,
     verbose: bool = True,
-) -> List[List[int]]:
+) -> Tuple[np.ndarray, np.ndarray]:
     """
     Load data and apply word2idx to each sentence.
+    Sentences are encoded in chunks with multiple threads
+    and stored as flat tokens with sentence offsets.
     """
 
-    data_list = []
+    dtype = get_token_dtype(language)
+
     with open(data_path, mode="r") as fp:
-        if verbose:
-            fp = tqdm(fp)
-        for line in fp:
-            data_list.append(
-                language.encode_sentence(line, add_bos=add_bos, add_eos=add_eos),
+        lines = fp.readlines()
+
+    chunks = range(0, len(lines), chunk_size)
+    if verbose:
+        chunks = tqdm(chunks)
+
+    tokens_list = [np.empty(0, dtype=dtype)]
+    lengths_list = [np.zeros(1, dtype=np.int64)]  # first offset
+    try:
+        for i in chunks:
+            seq_list = language.encode_sentences(
+                lines[i : i + chunk_size],
+                add_bos=add_bos,
+                add_eos=add_eos,
+                num_threads=num_threads,
             )
-    return data_list
+            tokens_list.append(np.fromiter(chain.from_iterable(seq_list), dtype=dtype))
+            lengths_list.append(
+                np.array([len(seq) for seq in seq_list], dtype=np.int64)
+            )
+    finally:
+        language.close_extra_tokenizers()  # not to keep tokenizer processes alive
+
+    tokens = np.concatenate(tokens_list)
+    offsets = np.cumsum(np.concatenate(lengths_list))
+    return tokens, offsets
+
+
+def get_cache_path(
+    data_path: str,
+    language: Language,
+    add_bos: bool = False,
+    add_eos: bool = False,
+    cache_dir: str = "~/.cache/wmt",
+) -> str:
+    """
+    Get cache path prefix from hash of data, vocabulary and encoding parameters.
+    """
+
+    key = json.dumps(
+        [
+            os.path.abspath(data_path),
+            os.path.getmtime(data_path),
+            os.path.abspath(language.path_to_word2idx),
+            os.path.getmtime(language.path_to_word2idx),
+            language.language,
+            language.unk_id,
+            language.bos_id,
+            language.eos_id,
+            add_bos,
+            add_eos,
+        ]
+    )
+    cache_hash = hashlib.md5(key.encode()).hexdigest()
+    return os.path.join(os.path.expanduser(cache_dir), cache_hash)
+
+
+def load_cached_data(
+    data_path: str,
+    language: Language,
+    add_bos: bool = False,
+    add_eos: bool = False,
+    cache_dir: str = "~/.cache/wmt",
+    verbose: bool = True,
+) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Load tokenized data as memory-mapped flat tokens with sentence offsets.
+    Data is tokenized only once and cached in cache_dir until data or vocabulary changes.
+    Tokens are stored as uint16 if vocabulary allows, else int32.
+    """
+
+    cache_path = get_cache_path(
+        data_path=data_path,
+        language=language,
+        add_bos=add_bos,
+        add_eos=add_eos,
+        cache_dir=cache_dir,
+    )
+    tokens_path = f"{cache_path}.tokens.npy"
+    offsets_path = f"{cache_path}.offsets.npy"
+
+    if not (os.path.exists(tokens_path) and os.path.exists(offsets_path)):
+        tokens, offsets = load_data(
+            data_path=data_path,
+            language=language,
+            add_bos=add_bos,
+            add_eos=add_eos,
+            verbose=verbose,
+        )
+
+        # write to temporary files first not to leave broken cache on interruption
+        os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+        for path, array in [(tokens_path, tokens), (offsets_path, offsets)]:
+            tmp_path = f"{path}.{os.getpid()}.tmp.npy"
+            np.save(tmp_path, array)
+            os.replace(tmp_path, path)
+
+    tokens = np.load(tokens_path, mmap_mode="r")
+    offsets = np.load(offsets_path)
+    return tokens, offsets
 
 
 def bucket_sequencing(
-    seq_list: List[List[int]],
+    seq_list: List[np.ndarray],
     percentile: Union[int, float],
     pad_id: int,
-) -> List[List[int]]:
+    pad_to_multiple_of: int = 1,
+) -> torch.Tensor:
     """
     Bucket sequencing for variable-size sentences.
+    Padded length is rounded up to pad_to_multiple_of (fewer distinct batch shapes).
     """
 
     max_len = int(
@@ -46,12 +169,20 @@ def bucket_sequencing(
         )
     )
 
-    for i in range(len(seq_list)):
-        seq = seq_list[i][:max_len]  # clip
-        seq += [pad_id] * (max_len - len(seq))  # pad
-        seq_list[i] = seq
+    seq = pad_sequence(
+        [
+            torch.from_numpy(np.asarray(seq[:max_len], dtype=np.int64))  # clip
+            for seq in seq_list
+        ],
+        batch_first=True,
+        padding_value=pad_id,
+    )  # pad
+
+    extra_len = -seq.size(1) % pad_to_multiple_of
+    if extra_len:
+        seq = F.pad(seq, (0, extra_len), value=pad_id)
 
-    return seq_list
+    return seq
 
 
 class WMTDataset(Dataset):
@@ -66,61 +197,201 @@ class WMTDataset(Dataset):
         input_language: Language,
         output_language: Language,
         reverse_source_lang: bool = True,
+        cache_dir: str = "~/.cache/wmt",
         verbose: bool = True,
     ):
         self.input_lang_data_path = input_lang_data_path
         self.output_lang_data_path = output_lang_data_path
+        self.reverse_source_lang = reverse_source_lang
 
         # language
         self.input_language = input_language
         self.output_language = output_language
 
         # load input language
-        self.input_lang_list = load_data(
+        self.input_lang_tokens, self.input_lang_offsets = load_cached_data(
             data_path=self.input_lang_data_path,
             language=self.input_language,
             add_bos=False,
             add_eos=False,
+            cache_dir=cache_dir,
             verbose=verbose,
         )
 
-        if reverse_source_lang:
-            self.input_lang_list = [
-                list(reversed(seq)) for seq in self.input_lang_list
-            ]  # reverse
-
         # load output language
-        self.output_lang_list = load_data(
+        self.output_lang_tokens, self.output_lang_offsets = load_cached_data(
             data_path=self.output_lang_data_path,
             language=self.output_language,
             add_bos=True,
             add_eos=True,
+            cache_dir=cache_dir,
             verbose=verbose,
         )
 
+        assert len(self.input_lang_offsets) == len(self.output_lang_offsets)
+
         # filter empty lines
-        good_idx = []
-        for i in range(len(self.input_lang_list)):
-            if (len(self.input_lang_list[i]) != 0) and (
-                len(self.output_lang_list[i]) != 0
-            ):
-                good_idx.append(i)
+        self.good_idx = np.flatnonzero(
+            (np.diff(self.input_lang_offsets) != 0)
+            & (np.diff(self.output_lang_offsets) != 0)
+        )
 
-        self.input_lang_list = [self.input_lang_list[i] for i in good_idx]
-        self.output_lang_list = [self.output_lang_list[i] for i in good_idx]
+        # lengths for batch samplers
+        self.input_lang_lengths = np.diff(self.input_lang_offsets)[self.good_idx]
+        self.output_lang_lengths = np.diff(self.output_lang_offsets)[self.good_idx]
 
     def __len__(self) -> int:
-        assert len(self.input_lang_list) == len(self.output_lang_list)
+        return len(self.good_idx)
 
-        return len(self.input_lang_list)
+    def __getitem__(self, idx: int) -> Tuple[np.ndarray, np.ndarray]:
+        idx = self.good_idx[idx]
 
-    def __getitem__(self, idx: int) -> Tuple[List[int], List[int]]:
-        return self.input_lang_list[idx], self.output_lang_list[idx]
+        input_lang_seq = self.input_lang_tokens[
+            self.input_lang_offsets[idx] : self.input_lang_offsets[idx + 1]
+        ]
+        output_lang_seq = self.output_lang_tokens[
+            self.output_lang_offsets[idx] : self.output_lang_offsets[idx + 1]
+        ]
+
+        if self.reverse_source_lang:
+            input_lang_seq = input_lang_seq[::-1]  # reverse
+
+        return input_lang_seq, output_lang_seq
+
+
+class BucketBatchSampler(Sampler):
+    """
+    Batch sampler that groups sentences of similar length to reduce padding.
+    Shuffled data is split into buckets of bucket_size batches,
+    each bucket is sorted by (input, output) lengths and split into batches.
+    Batches are still padded to their longest sentence, use WMTCollator
+    pad_to_multiple_of to limit number of distinct batch shapes.
+    """
+
+    def __init__(
+        self,
+        input_lang_lengths: np.ndarray,
+        output_lang_lengths: np.ndarray,
+        batch_size: int,
+        bucket_size: int = 100,
+        shuffle: bool = True,
+        drop_last: bool = False,
+    ):
+        assert len(input_lang_lengths) == len(output_lang_lengths)
+
+        self.input_lang_lengths = input_lang_lengths
+        self.output_lang_lengths = output_lang_lengths
+        self.batch_size = batch_size
+        self.bucket_size = bucket_size
+        self.shuffle = shuffle
+        self.drop_last = drop_last
+
+    def __iter__(self) -> Iterator[List[int]]:
+        n = len(self.input_lang_lengths)
+        idx = np.random.permutation(n) if self.shuffle else np.arange(n)
+
+        batches = []
+        window = self.batch_size * self.bucket_size
+        for start in range(0, n, window):
+            bucket = idx[start : start + window]
+            bucket = bucket[
+                np.lexsort(
+                    (self.output_lang_lengths[bucket], self.input_lang_lengths[bucket])
+                )
+            ]
+            for i in range(0, len(bucket), self.batch_size):
+                batch = bucket[i : i + self.batch_size]
+                if self.drop_last and (len(batch) < self.batch_size):
+                    continue
+                batches.append(batch.tolist())
+
+        if self.shuffle:
+            batches = [batches[i] for i in np.random.permutation(len(batches))]
+
+        return iter(batches)
+
+    def __len__(self) -> int:
+        n = len(self.input_lang_lengths)
+        window = self.batch_size * self.bucket_size
+
+        n_full_buckets, last_bucket = divmod(n, window)
+        if self.drop_last:
+            return n_full_buckets * self.bucket_size + last_bucket // self.batch_size
+        return n_full_buckets * self.bucket_size + -(-last_bucket // self.batch_size)
+
+
+class MaxTokensBatchSampler(Sampler):
+    """
+    Batch sampler that fills batches up to max_tokens (with padding) instead of
+    fixed number of sentences. Data is sorted by (input, output) lengths,
+    sentences of the same length are shuffled, batches order is shuffled.
+    Pad multiples should match WMTCollator to budget padded lengths.
+    """
+
+    def __init__(
+        self,
+        input_lang_lengths: np.ndarray,
+        output_lang_lengths: np.ndarray,
+        max_tokens: int = 8192,
+        shuffle: bool = True,
+        input_lang_pad_to_multiple_of: int = 1,
+        output_lang_pad_to_multiple_of: int = 1,
+    ):
+        assert len(input_lang_lengths) == len(output_lang_lengths)
+
+        self.input_lang_lengths = input_lang_lengths
+        self.output_lang_lengths = output_lang_lengths
+        self.max_tokens = max_tokens
+        self.shuffle = shuffle
+
+        # lengths after collator rounding (ceil to multiple)
+        m_in, m_out = input_lang_pad_to_multiple_of, output_lang_pad_to_multiple_of
+        self.padded_lengths = np.maximum(
+            -(-input_lang_lengths // m_in) * m_in,
+            -(-output_lang_lengths // m_out) * m_out,
+        )
+
+        # number of batches doesn't depend on order of sentences of the same length
+        self.n_batches = len(self._get_batches(np.arange(len(input_lang_lengths))))
+
+    def _get_batches(self, idx: np.ndarray) -> List[List[int]]:
+        idx = idx[
+            np.lexsort((self.output_lang_lengths[idx], self.input_lang_lengths[idx]))
+        ]
+        lengths = self.padded_lengths[idx]
+
+        batches: List[List[int]] = []
+        batch: List[int] = []
+        max_len = 0
+        for i, length in zip(idx.tolist(), lengths.tolist()):
+            max_len = max(max_len, length)
+            if batch and (max_len * (len(batch) + 1) > self.max_tokens):
+                batches.append(batch)
+                batch, max_len = [], length
+            batch.append(i)
+        if batch:
+            batches.append(batch)
+
+        return batches
+
+    def __iter__(self) -> Iterator[List[int]]:
+        n = len(self.input_lang_lengths)
+        idx = np.random.permutation(n) if self.shuffle else np.arange(n)
+
+        batches = self._get_batches(idx)
+        if self.shuffle:
+            batches = [batches[i] for i in np.random.permutation(len(batches))]
+
+        return iter(batches)
+
+    def __len__(self) -> int:
+        return self.n_batches
 
 
 class WMTCollator(object):
     """
     Collator that handles variable-size sentences.
+    Input language lengths are returned on host (for sequence packing).
     """
 
     def __init__(
@@ -128,32 +399,37 @@ class WMTCollator(object):
         input_lang_pad_id: int = 3,
         output_lang_pad_id: int = 3,
         percentile: Union[int, float] = 100,
+        input_lang_pad_to_multiple_of: int = 1,
+        output_lang_pad_to_multiple_of: int = 1,
     ):
         self.input_lang_pad_id = input_lang_pad_id
         self.output_lang_pad_id = output_lang_pad_id
         self.percentile = percentile
+        self.input_lang_pad_to_multiple_of = input_lang_pad_to_multiple_of
+        self.output_lang_pad_to_multiple_of = output_lang_pad_to_multiple_of
 
     def __call__(
         self,
-        batch: List[Tuple[List[int], List[int]]],
-    ) -> Tuple[torch.Tensor, torch.Tensor]:
+        batch: List[Tuple[np.ndarray, np.ndarray]],
+    ) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor]:
 
         input_lang_tuple, output_lang_tuple = zip(*batch)
-        input_lang_list, output_lang_list = list(input_lang_tuple), list(
-            output_lang_tuple
-        )
 
         # bucket sequencing
-        input_lang_list = bucket_sequencing(
-            input_lang_list,
+        input_lang_seq = bucket_sequencing(
+            list(input_lang_tuple),
             percentile=self.percentile,
             pad_id=self.input_lang_pad_id,
+            pad_to_multiple_of=self.input_lang_pad_to_multiple_of,
         )
 
-        output_lang_list = bucket_sequencing(
-            output_lang_list,
+        output_lang_seq = bucket_sequencing(
+            list(output_lang_tuple),
             percentile=self.percentile,
             pad_id=self.output_lang_pad_id,
+            pad_to_multiple_of=self.output_lang_pad_to_multiple_of,
         )
 
-        return torch.tensor(input_lang_list), torch.tensor(output_lang_list)
+        input_lang_lengths = infer_length(input_lang_seq, pad_id=self.input_lang_pad_id)
+
+        return input_lang_seq, output_lang_seq, input_lang_lengths
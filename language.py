@@ -1,5 +1,8 @@
 import json
-from typing import List
+import os
+from itertools import chain
+from multiprocessing.pool import ThreadPool
+from typing import List, Optional
 
 from mosestokenizer import MosesTokenizer
 
@@ -24,6 +27,7 @@ class Language:
         self.eos_id = eos_id
 
         self.tokenizer = MosesTokenizer(language)
+        self.tokenizers = [self.tokenizer]  # one tokenizer process per thread
         with open(path_to_word2idx, mode="r") as fp:
             self.word2idx = json.load(fp)
         self.idx2word = {v: k for k, v in self.word2idx.items()}
@@ -34,9 +38,77 @@ class Language:
         add_bos: bool = False,
         add_eos: bool = False,
     ) -> List[int]:
-        seq = [
-            self.word2idx.get(word, self.unk_id) for word in self.tokenizer(sentence)
+        return self._encode_sentence(
+            sentence,
+            tokenizer=self.tokenizer,
+            add_bos=add_bos,
+            add_eos=add_eos,
+        )
+
+    def encode_sentences(
+        self,
+        sentences: List[str],
+        add_bos: bool = False,
+        add_eos: bool = False,
+        num_threads: Optional[int] = None,
+    ) -> List[List[int]]:
+        """
+        Encode batch of sentences in parallel (tokenizer process per thread).
+        Tokenizer processes are reused between calls until close_extra_tokenizers.
+        """
+
+        if num_threads is None:
+            num_threads = os.cpu_count() or 1
+        num_threads = max(1, min(num_threads, len(sentences)))
+
+        while len(self.tokenizers) < num_threads:
+            self.tokenizers.append(MosesTokenizer(self.language))
+
+        step = -(-len(sentences) // num_threads)  # ceil
+        with ThreadPool(num_threads) as pool:
+            seq_lists = pool.starmap(
+                self._encode_sentences,
+                [
+                    (sentences[i * step : (i + 1) * step], tokenizer, add_bos, add_eos)
+                    for i, tokenizer in enumerate(self.tokenizers[:num_threads])
+                ],
+            )
+        return list(chain.from_iterable(seq_lists))
+
+    def close_extra_tokenizers(self):
+        """
+        Close tokenizer processes started by encode_sentences (keep self.tokenizer).
+        """
+
+        for tokenizer in self.tokenizers[1:]:
+            tokenizer.close()
+        self.tokenizers = [self.tokenizer]
+
+    def _encode_sentences(
+        self,
+        sentences: List[str],
+        tokenizer: MosesTokenizer,
+        add_bos: bool = False,
+        add_eos: bool = False,
+    ) -> List[List[int]]:
+        return [
+            self._encode_sentence(
+                sentence,
+                tokenizer=tokenizer,
+                add_bos=add_bos,
+                add_eos=add_eos,
+            )
+            for sentence in sentences
         ]
+
+    def _encode_sentence(
+        self,
+        sentence: str,
+        tokenizer: MosesTokenizer,
+        add_bos: bool = False,
+        add_eos: bool = False,
+    ) -> List[int]:
+        seq = [self.word2idx.get(word, self.unk_id) for word in tokenizer(sentence)]
         if add_bos:
             seq.insert(0, self.bos_id)
         if add_eos:
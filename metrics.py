@@ -1,20 +1,32 @@
-from typing import DefaultDict, List, Optional
+from typing import List, Union
 from warnings import filterwarnings
 
+import torch
 from nltk.translate.bleu_score import SmoothingFunction, corpus_bleu
 
+from utils import to_numpy
+
 filterwarnings(action="ignore", category=UserWarning)
 
 
-def calculate_metrics(
-    metrics: DefaultDict[str, List[float]],
-    loss: float,
+def remove_padding(
+    seq: torch.Tensor,
+    pad_mask: torch.Tensor,
+) -> List[List[int]]:
+    """
+    Convert batch to list of sequences without <PAD> (padded on the right).
+    """
+
+    lengths = to_numpy(pad_mask.sum(dim=-1)).tolist()
+    return [s[:length] for s, length in zip(to_numpy(seq).tolist(), lengths)]
+
+
+def calculate_bleu_score(
     y_true: List[List[int]],
     y_pred: List[List[int]],
-    grad_norm: Optional[float] = None,
-) -> DefaultDict[str, List[float]]:
+) -> float:
     """
-    Calculate metrics on epoch.
+    Calculate corpus BLEU score.
     """
 
     smoothing_function = SmoothingFunction()
@@ -23,11 +35,38 @@ def calculate_metrics(
         hypotheses=y_pred,
         smoothing_function=smoothing_function.method0,  # no smoothing
     )
+    return bleu_score
+
+
+def calculate_accuracy(
+    y_true: torch.Tensor,
+    y_pred: torch.Tensor,
+    pad_mask: torch.Tensor,
+) -> torch.Tensor:
+    """
+    Calculate token accuracy over pad_mask on device (without host sync).
+    """
+
+    return ((y_true == y_pred) & pad_mask).sum() / pad_mask.sum()
+
+
+class RunningMean:
+    """
+    Weighted running mean with sum accumulated on device.
+    No host sync until mean is read, O(1) memory and update.
+    """
+
+    def __init__(self, device: torch.device):
+        self.sum = torch.zeros((), device=device)
+        self.weight = torch.zeros((), device=device)
 
-    metrics["loss"].append(loss)
-    metrics["bleu_score"].append(bleu_score)
+    def update(self, value: torch.Tensor, weight: Union[int, torch.Tensor] = 1):
+        self.sum += value.detach().float() * weight
+        self.weight += weight
 
-    if grad_norm is not None:
-        metrics["grad_norm"].append(grad_norm)
+    def mean(self) -> float:
+        return (self.sum / self.weight).item()
 
-    return metrics
+    def reset(self):
+        self.sum.zero_()
+        self.weight.zero_()
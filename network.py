@@ -1,5 +1,6 @@
-from typing import Union
+from typing import Optional, Union
 
+import torch
 import torch.nn as nn
 from torch.nn.utils.rnn import pack_padded_sequence
 
@@ -34,11 +35,19 @@ class Seq2SeqRNNEncoder(nn.Module):
             batch_first=True,
         )
 
-    def forward(self, x):
+    def forward(self, x, lengths: Optional[torch.Tensor] = None):
         embed = self.encoder_embedding(x)
 
+        if lengths is None:
+            lengths = infer_length(x, pad_id=3)
+        lengths = lengths.cpu()
+
+        # no <PAD> in batch: plain cuDNN call without packing
+        if bool((lengths == x.size(1)).all()):
+            _, hidden = self.encoder(embed)
+            return hidden
+
         # select last hidden before <PAD>
-        lengths = infer_length(x, pad_id=3)
         packed_enc_emb = pack_padded_sequence(
             embed,
             lengths,
@@ -122,7 +131,12 @@ class Seq2SeqModel(nn.Module):
             decoder_dropout=decoder_dropout,
         )
 
-    def forward(self, input_lang_seq, output_lang_seq):
-        decoder_hidden = self.encoder(input_lang_seq)
+    def forward(
+        self,
+        input_lang_seq,
+        output_lang_seq,
+        input_lang_lengths: Optional[torch.Tensor] = None,
+    ):
+        decoder_hidden = self.encoder(input_lang_seq, lengths=input_lang_lengths)
         logits = self.decoder(output_lang_seq, decoder_hidden=decoder_hidden)
         return logits
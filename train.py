@@ -3,9 +3,9 @@ import os
 import torch
 import torch.nn as nn
 import torch.optim as optim
-from torch.utils.data import DataLoader
+from torch.utils.data import DataLoader, Sampler
 
-from dataset import WMTCollator, WMTDataset
+from dataset import BucketBatchSampler, MaxTokensBatchSampler, WMTCollator, WMTDataset
 from language import Language
 from network import Seq2SeqModel
 from train_utils import train
@@ -25,10 +25,12 @@ INPUT_LANG_WORD2IDX_PATH = f"vocab/{INPUT_LANG}_vocab.json"
 OUTPUT_LANG_WORD2IDX_PATH = f"vocab/{OUTPUT_LANG}_vocab.json"
 
 SAVE_MODEL_PATH = "models/seq2seq.pth"
+CACHE_DIR = "~/.cache/wmt"  # tokenized data cache
 
 # hyper-parameters
 SEED = 42
 DEVICE = "cuda"
+FLOAT32_MATMUL_PRECISION = "high"  # "high" allows TF32 matmuls, "highest" - pure fp32
 VERBOSE = True
 
 UNK_ID = 0
@@ -37,6 +39,11 @@ EOS_ID = 2
 PAD_ID = 3
 
 BATCH_SIZE = 32
+BUCKET_SIZE = 100  # number of batches in bucket of similar length sentences
+MAX_TOKENS = None  # if not None, batch by number of tokens instead of BATCH_SIZE
+NUM_WORKERS = max(1, (os.cpu_count() or 1) // 2)
+PREFETCH_FACTOR = 4
+PIN_MEMORY = True
 REVERSE_SOURCE_LANG = True
 BUCKET_SEQUENCING_PERCENTILE = 100
 
@@ -48,6 +55,21 @@ ENCODER_DROPOUT = DECODER_DROPOUT = 0.2
 N_EPOCH = 12
 LEARNING_RATE = 1
 TRAIN_EVAL_FREQ = 50  # number of batches
+# mixed precision: torch.bfloat16, torch.float16 or None
+# bfloat16 needs Ampere+ GPU, float16 uses loss scaling (not supported with CUDA_GRAPH)
+AMP_DTYPE = (
+    (torch.bfloat16 if torch.cuda.is_bf16_supported() else torch.float16)
+    if torch.cuda.is_available()
+    else None  # float16 autocast is not supported on CPU
+)
+CUDA_GRAPH = False  # replay batches without <PAD> in source with CUDA Graphs
+CUDA_GRAPH_CACHE_SIZE = 128  # max number of captured batch shapes (LRU)
+CUDA_GRAPH_MIN_COUNT = 3  # capture batch shape after it was seen this many times
+COMPILE_MODEL = False  # torch.compile embedding/linear layers (nn.LSTM is not traced)
+
+# round padded lengths (fewer batch shapes for CUDA_GRAPH / COMPILE_MODEL only)
+INPUT_LANG_PAD_TO_MULTIPLE_OF = 1  # 1 keeps sorted source batches without <PAD>
+OUTPUT_LANG_PAD_TO_MULTIPLE_OF = 8 if (CUDA_GRAPH or COMPILE_MODEL) else 1
 
 
 # print params
@@ -67,9 +89,11 @@ if VERBOSE:
     print(f"OUTPUT_LANG_WORD2IDX_PATH: {OUTPUT_LANG_WORD2IDX_PATH}")
     print()
     print(f"SAVE_MODEL_PATH: {SAVE_MODEL_PATH}")
+    print(f"CACHE_DIR: {CACHE_DIR}")
     print()
     print(f"SEED: {SEED}")
     print(f"DEVICE: {DEVICE}")
+    print(f"FLOAT32_MATMUL_PRECISION: {FLOAT32_MATMUL_PRECISION}")
     print()
     print(f"UNK_ID: {UNK_ID}")
     print(f"BOS_ID: {BOS_ID}")
@@ -77,6 +101,11 @@ if VERBOSE:
     print(f"PAD_ID: {PAD_ID}")
     print()
     print(f"BATCH_SIZE: {BATCH_SIZE}")
+    print(f"BUCKET_SIZE: {BUCKET_SIZE}")
+    print(f"MAX_TOKENS: {MAX_TOKENS}")
+    print(f"NUM_WORKERS: {NUM_WORKERS}")
+    print(f"PREFETCH_FACTOR: {PREFETCH_FACTOR}")
+    print(f"PIN_MEMORY: {PIN_MEMORY}")
     print(f"REVERSE_SOURCE_LANG: {REVERSE_SOURCE_LANG}")
     print(f"BUCKET_SEQUENCING_PERCENTILE: {BUCKET_SEQUENCING_PERCENTILE}")
     print()
@@ -88,12 +117,21 @@ if VERBOSE:
     print(f"N_EPOCH: {N_EPOCH}")
     print(f"LEARNING_RATE: {LEARNING_RATE}")
     print(f"TRAIN_EVAL_FREQ: {TRAIN_EVAL_FREQ}")
+    print(f"AMP_DTYPE: {AMP_DTYPE}")
+    print(f"CUDA_GRAPH: {CUDA_GRAPH}")
+    print(f"CUDA_GRAPH_CACHE_SIZE: {CUDA_GRAPH_CACHE_SIZE}")
+    print(f"CUDA_GRAPH_MIN_COUNT: {CUDA_GRAPH_MIN_COUNT}")
+    print(f"COMPILE_MODEL: {COMPILE_MODEL}")
+    print()
+    print(f"INPUT_LANG_PAD_TO_MULTIPLE_OF: {INPUT_LANG_PAD_TO_MULTIPLE_OF}")
+    print(f"OUTPUT_LANG_PAD_TO_MULTIPLE_OF: {OUTPUT_LANG_PAD_TO_MULTIPLE_OF}")
     print()
 
 
 # seed and device
 set_global_seed(SEED)
 device = torch.device(DEVICE)
+torch.set_float32_matmul_precision(FLOAT32_MATMUL_PRECISION)
 
 
 # language
@@ -120,6 +158,7 @@ train_dataset = WMTDataset(
     input_language=input_language,
     output_language=output_language,
     reverse_source_lang=REVERSE_SOURCE_LANG,
+    cache_dir=CACHE_DIR,
     verbose=VERBOSE,
 )
 val_dataset = WMTDataset(
@@ -128,6 +167,7 @@ val_dataset = WMTDataset(
     input_language=input_language,
     output_language=output_language,
     reverse_source_lang=REVERSE_SOURCE_LANG,
+    cache_dir=CACHE_DIR,
     verbose=VERBOSE,
 )
 test_dataset = WMTDataset(
@@ -136,6 +176,7 @@ test_dataset = WMTDataset(
     input_language=input_language,
     output_language=output_language,
     reverse_source_lang=REVERSE_SOURCE_LANG,
+    cache_dir=CACHE_DIR,
     verbose=VERBOSE,
 )
 
@@ -143,6 +184,8 @@ train_collator = WMTCollator(
     input_lang_pad_id=PAD_ID,
     output_lang_pad_id=PAD_ID,
     percentile=BUCKET_SEQUENCING_PERCENTILE,
+    input_lang_pad_to_multiple_of=INPUT_LANG_PAD_TO_MULTIPLE_OF,
+    output_lang_pad_to_multiple_of=OUTPUT_LANG_PAD_TO_MULTIPLE_OF,
 )
 test_collator = WMTCollator(  # same for val_loader
     input_lang_pad_id=PAD_ID,
@@ -150,23 +193,53 @@ test_collator = WMTCollator(  # same for val_loader
     percentile=100,
 )
 
+train_sampler: Sampler
+if MAX_TOKENS is not None:
+    train_sampler = MaxTokensBatchSampler(
+        input_lang_lengths=train_dataset.input_lang_lengths,
+        output_lang_lengths=train_dataset.output_lang_lengths,
+        max_tokens=MAX_TOKENS,
+        shuffle=True,
+        input_lang_pad_to_multiple_of=INPUT_LANG_PAD_TO_MULTIPLE_OF,
+        output_lang_pad_to_multiple_of=OUTPUT_LANG_PAD_TO_MULTIPLE_OF,
+    )
+else:
+    train_sampler = BucketBatchSampler(
+        input_lang_lengths=train_dataset.input_lang_lengths,
+        output_lang_lengths=train_dataset.output_lang_lengths,
+        batch_size=BATCH_SIZE,
+        bucket_size=BUCKET_SIZE,
+        shuffle=True,
+    )
+
 train_loader = DataLoader(
     dataset=train_dataset,
-    batch_size=BATCH_SIZE,
-    shuffle=True,
+    batch_sampler=train_sampler,
     collate_fn=train_collator,
+    num_workers=NUM_WORKERS,
+    prefetch_factor=PREFETCH_FACTOR,
+    persistent_workers=True,
+    pin_memory=PIN_MEMORY and not CUDA_GRAPH,  # pin thread breaks graph capture
 )
 val_loader = DataLoader(
     dataset=val_dataset,
-    batch_size=1,
+    batch_size=BATCH_SIZE,
     shuffle=False,
     collate_fn=test_collator,
+    num_workers=NUM_WORKERS,
+    prefetch_factor=PREFETCH_FACTOR,
+    persistent_workers=False,  # not to keep idle workers between epochs
+    pin_memory=PIN_MEMORY,
 )
 test_loader = DataLoader(
     dataset=test_dataset,
-    batch_size=1,
+    batch_size=BATCH_SIZE,
     shuffle=False,
     collate_fn=test_collator,
+    num_workers=NUM_WORKERS,
+    prefetch_factor=PREFETCH_FACTOR,
+    persistent_workers=False,  # not to keep idle workers between epochs
+    pin_memory=PIN_MEMORY,
 )
 
 
@@ -187,6 +260,14 @@ model = Seq2SeqModel(
 if VERBOSE:
     print(f"model number of parameters: {sum(p.numel() for p in model.parameters())}")
 
+# compile non-recurrent layers (compiled model shares parameters with model)
+# dynamic shapes not to recompile on every new batch shape
+if COMPILE_MODEL:
+    assert not CUDA_GRAPH, "CUDA_GRAPH and COMPILE_MODEL are mutually exclusive"
+    compiled_model = torch.compile(model, dynamic=True, fullgraph=False)
+else:
+    compiled_model = model
+
 
 # criterion, optimizer, scheduler
 criterion = nn.CrossEntropyLoss(
@@ -205,7 +286,7 @@ scheduler = optim.lr_scheduler.MultiStepLR(  # hardcoded
 
 # train
 train(
-    model=model,
+    model=compiled_model,
     trainloader=train_loader,
     valloader=val_loader,
     testloader=test_loader,
@@ -214,6 +295,11 @@ train(
     scheduler=scheduler,
     n_epoch=N_EPOCH,
     train_eval_freq=TRAIN_EVAL_FREQ,
+    pad_id=PAD_ID,
+    amp_dtype=AMP_DTYPE,
+    cuda_graph=CUDA_GRAPH,
+    cuda_graph_cache_size=CUDA_GRAPH_CACHE_SIZE,
+    cuda_graph_min_count=CUDA_GRAPH_MIN_COUNT,
     device=device,
     verbose=VERBOSE,
 )
@@ -1,15 +1,241 @@
-from collections import defaultdict
-from typing import Callable, DefaultDict, List, Optional
+from collections import Counter, OrderedDict, defaultdict
+from typing import Callable, DefaultDict, Iterator, List, Optional, Tuple
 
 import numpy as np
 import torch
 import torch.nn as nn
 import torch.optim as optim
+from torch.cuda.amp import GradScaler
 from torch.utils.data import DataLoader
 from tqdm import tqdm
 
-from metrics import calculate_metrics
-from utils import to_numpy
+from metrics import (
+    RunningMean,
+    calculate_accuracy,
+    calculate_bleu_score,
+    remove_padding,
+)
+
+Batch = Tuple[torch.Tensor, torch.Tensor, torch.Tensor]
+
+BatchShape = Tuple[torch.Size, torch.Size]
+
+CUDAGraphStep = Tuple[
+    torch.cuda.CUDAGraph,
+    Tuple[torch.Tensor, torch.Tensor],
+    Tuple[torch.Tensor, torch.Tensor, torch.Tensor],
+]
+
+
+class CUDAPrefetcher:
+    """
+    DataLoader wrapper that copies next batch to device on side CUDA stream
+    while current batch is processed. Input language lengths stay on host.
+    """
+
+    def __init__(self, dataloader: DataLoader, device: torch.device):
+        self.dataloader = dataloader
+        self.device = device
+
+    def __len__(self) -> int:
+        return len(self.dataloader)
+
+    def __iter__(self) -> Iterator[Batch]:
+        stream = torch.cuda.Stream(device=self.device)
+        batches = iter(self.dataloader)
+
+        next_batch = self._preload(next(batches, None), stream=stream)
+        while next_batch is not None:
+            current_stream = torch.cuda.current_stream(device=self.device)
+            current_stream.wait_stream(stream)
+
+            batch = next_batch
+            for tensor in batch[:2]:
+                tensor.record_stream(current_stream)  # allocated on side stream
+
+            next_batch = self._preload(next(batches, None), stream=stream)
+            yield batch
+
+    def _preload(
+        self,
+        batch: Optional[Batch],
+        stream: torch.cuda.Stream,
+    ) -> Optional[Batch]:
+        if batch is None:
+            return None
+
+        input_lang_seq, output_lang_seq, input_lang_lengths = batch
+        with torch.cuda.stream(stream):
+            input_lang_seq = input_lang_seq.to(self.device, non_blocking=True)
+            output_lang_seq = output_lang_seq.to(self.device, non_blocking=True)
+        return input_lang_seq, output_lang_seq, input_lang_lengths
+
+
+def compute_loss(
+    model: nn.Module,
+    criterion: Callable,
+    input_lang_seq: torch.Tensor,
+    output_lang_seq: torch.Tensor,
+    input_lang_lengths: Optional[torch.Tensor] = None,
+    amp_dtype: Optional[torch.dtype] = None,
+) -> Tuple[torch.Tensor, torch.Tensor]:
+    """
+    Forward pass with teacher forcing.
+    If amp_dtype is passed, forward pass is in mixed precision.
+    """
+
+    inputs = (input_lang_seq, output_lang_seq[:, :-1], input_lang_lengths)
+    targets = output_lang_seq[:, 1:]
+
+    with torch.autocast(
+        device_type=input_lang_seq.device.type,
+        dtype=amp_dtype,
+        enabled=amp_dtype is not None,
+    ):
+        outputs = model(*inputs)
+        loss = criterion(  # ignore index used
+            outputs.reshape(-1, outputs.size(-1)),  # view, no transpose copy
+            targets.reshape(-1),
+        )
+    return outputs, loss
+
+
+def train_step(
+    model: nn.Module,
+    criterion: Callable,
+    optimizer: optim.Optimizer,
+    scaler: GradScaler,
+    input_lang_seq: torch.Tensor,
+    output_lang_seq: torch.Tensor,
+    input_lang_lengths: Optional[torch.Tensor] = None,
+    amp_dtype: Optional[torch.dtype] = None,
+) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor]:
+    """
+    Training step on one batch.
+    """
+
+    # free grads before forward pass (backward allocates new ones)
+    optimizer.zero_grad(set_to_none=True)
+
+    # forward pass
+    outputs, loss = compute_loss(
+        model=model,
+        criterion=criterion,
+        input_lang_seq=input_lang_seq,
+        output_lang_seq=output_lang_seq,
+        input_lang_lengths=input_lang_lengths,
+        amp_dtype=amp_dtype,
+    )
+
+    # backward pass
+    scaler.scale(loss).backward()
+
+    # clip grad norm
+    scaler.unscale_(optimizer)
+    grad_norm = nn.utils.clip_grad_norm_(
+        model.parameters(),
+        max_norm=5,  # hardcoded
+    )
+
+    # optimizer step
+    scaler.step(optimizer)
+    scaler.update()
+
+    return outputs, loss, grad_norm
+
+
+def capture_train_step(
+    model: nn.Module,
+    criterion: Callable,
+    optimizer: optim.Optimizer,
+    scaler: GradScaler,
+    input_lang_seq: torch.Tensor,
+    output_lang_seq: torch.Tensor,
+    input_lang_lengths: torch.Tensor,
+    amp_dtype: Optional[torch.dtype] = None,
+    n_warmup: int = 3,
+    pool: Optional[Tuple[int, int]] = None,
+) -> CUDAGraphStep:
+    """
+    Capture training step into CUDA Graph to replay on batches of the same shape.
+    Source batch should be without <PAD> (sequence packing is not capturable),
+    scaler should be disabled (loss scaling syncs with host).
+    Optimizer hyper-parameters (lr) are baked into graph, recapture on change.
+    If pool is passed, graph memory pool is shared with other graphs.
+    Capture is in global mode (torch 2.0), so no other thread should use CUDA
+    during it (e.g. DataLoader pin_memory thread).
+    """
+
+    static_inputs = (input_lang_seq.clone(), output_lang_seq.clone())
+
+    # warmup on side stream (without optimizer step)
+    stream = torch.cuda.Stream()
+    stream.wait_stream(torch.cuda.current_stream())
+    with torch.cuda.stream(stream):
+        for _ in range(n_warmup):
+            _, loss = compute_loss(
+                model,
+                criterion,
+                *static_inputs,
+                input_lang_lengths=input_lang_lengths,
+                amp_dtype=amp_dtype,
+            )
+            loss.backward()
+    torch.cuda.current_stream().wait_stream(stream)
+
+    # grads are allocated from graph memory pool during capture
+    graph = torch.cuda.CUDAGraph()
+    with torch.cuda.graph(graph, pool=pool):
+        static_outputs = train_step(
+            model,
+            criterion,
+            optimizer,
+            scaler,
+            *static_inputs,
+            input_lang_lengths=input_lang_lengths,
+            amp_dtype=amp_dtype,
+        )
+
+    return graph, static_inputs, static_outputs
+
+
+class CUDAGraphCache:
+    """
+    LRU cache of CUDA Graph training steps by batch shape.
+    Batch shape is captured only after it was seen min_count times,
+    all graphs share one memory pool (graphs are never replayed concurrently).
+    """
+
+    def __init__(self, max_size: int = 64, min_count: int = 3):
+        self.max_size = max_size
+        self.min_count = min_count
+
+        self.graphs: "OrderedDict[BatchShape, CUDAGraphStep]" = OrderedDict()
+        self.counts: Counter = Counter()
+        self.pool = torch.cuda.graph_pool_handle()
+
+    def __len__(self) -> int:
+        return len(self.graphs)
+
+    def get(self, key: BatchShape) -> Optional[CUDAGraphStep]:
+        if key in self.graphs:
+            self.graphs.move_to_end(key)
+            return self.graphs[key]
+
+        self.counts[key] += 1
+        return None
+
+    def should_capture(self, key: BatchShape) -> bool:
+        return self.counts[key] >= self.min_count
+
+    def add(self, key: BatchShape, graph_step: CUDAGraphStep):
+        self.graphs[key] = graph_step
+        if len(self.graphs) > self.max_size:
+            self.graphs.popitem(last=False)  # least recently used
+
+    def clear(self):
+        self.graphs.clear()
+        self.pool = torch.cuda.graph_pool_handle()
 
 
 def train_epoch(
@@ -19,61 +245,123 @@ def train_epoch(
     optimizer: optim.Optimizer,
     device: torch.device,
     train_eval_freq: int = 500,
+    pad_id: int = 3,
+    scaler: Optional[GradScaler] = None,
+    amp_dtype: Optional[torch.dtype] = None,
+    cuda_graphs: Optional[CUDAGraphCache] = None,
     verbose: bool = True,
 ):
     """
     Training loop on one epoch.
+    Loss, accuracy (weighted by target tokens) and grad norm (over steps not skipped
+    by scaler) are accumulated on device and read every train_eval_freq batches,
+    BLEU score is sampled on the last batch of each window (sampled_bleu_score).
+    If amp_dtype is passed, training is in mixed precision (scaler for float16).
+    If cuda_graphs is passed, batches without <PAD> in source are replayed
+    with CUDA Graphs captured once per frequent batch shape and cached in cuda_graphs.
     """
 
-    metrics: DefaultDict[str, List[float]] = defaultdict(list)
+    if scaler is None:
+        scaler = GradScaler(enabled=False)
+
+    # accumulate on device not to sync with host every batch
+    window_metrics: DefaultDict[str, RunningMean] = defaultdict(
+        lambda: RunningMean(device=device)
+    )
+    epoch_metrics: DefaultDict[str, RunningMean] = defaultdict(
+        lambda: RunningMean(device=device)
+    )
+    bleu_score_list: List[float] = []
+
+    if device.type == "cuda":
+        dataloader = CUDAPrefetcher(dataloader, device=device)  # type: ignore
 
     if verbose:
         dataloader = tqdm(dataloader)
 
     model.train()
 
-    for i, (input_lang_seq, output_lang_seq) in enumerate(dataloader):
-        input_lang_seq = input_lang_seq.to(device)
-        output_lang_seq = output_lang_seq.to(device)
-
-        inputs = (input_lang_seq, output_lang_seq[:, :-1])
-        targets = output_lang_seq[:, 1:]
-
-        # forward pass
-        outputs = model(*inputs)
-        loss = criterion(outputs.transpose(1, 2), targets)  # ignore index used
-
-        # backward pass
-        loss.backward()
-
-        # clip grad norm
-        grad_norm = nn.utils.clip_grad_norm_(
-            model.parameters(),
-            max_norm=5,  # hardcoded
-        )
+    for i, (input_lang_seq, output_lang_seq, input_lang_lengths) in enumerate(
+        dataloader
+    ):
+        input_lang_seq = input_lang_seq.to(device, non_blocking=True)
+        output_lang_seq = output_lang_seq.to(device, non_blocking=True)
+
+        graph_step = None
+        if (cuda_graphs is not None) and bool(
+            (input_lang_lengths == input_lang_seq.size(1)).all()
+        ):
+            key = (input_lang_seq.shape, output_lang_seq.shape)
+            graph_step = cuda_graphs.get(key)
+            if (graph_step is None) and cuda_graphs.should_capture(key):
+                graph_step = capture_train_step(
+                    model=model,
+                    criterion=criterion,
+                    optimizer=optimizer,
+                    scaler=scaler,
+                    input_lang_seq=input_lang_seq,
+                    output_lang_seq=output_lang_seq,
+                    input_lang_lengths=input_lang_lengths,
+                    amp_dtype=amp_dtype,
+                    pool=cuda_graphs.pool,
+                )
+                cuda_graphs.add(key, graph_step)
+
+        if graph_step is not None:
+            graph, static_inputs, (outputs, loss, grad_norm) = graph_step
+            static_inputs[0].copy_(input_lang_seq)
+            static_inputs[1].copy_(output_lang_seq)
+            graph.replay()
+
+        else:
+            outputs, loss, grad_norm = train_step(
+                model=model,
+                criterion=criterion,
+                optimizer=optimizer,
+                scaler=scaler,
+                input_lang_seq=input_lang_seq,
+                output_lang_seq=output_lang_seq,
+                input_lang_lengths=input_lang_lengths,
+                amp_dtype=amp_dtype,
+            )
+
+        y_true = output_lang_seq[:, 1:]
+        y_pred = outputs.argmax(dim=-1)
+        pad_mask = y_true != pad_id
+        n_tokens = pad_mask.sum()
+        accuracy = calculate_accuracy(y_true=y_true, y_pred=y_pred, pad_mask=pad_mask)
+
+        # steps skipped by scaler on overflow have inf grad norm, zero weight
+        is_finite = torch.isfinite(grad_norm)
+        grad_norm = torch.where(is_finite, grad_norm, torch.zeros_like(grad_norm))
+
+        for running_metrics in [window_metrics, epoch_metrics]:
+            running_metrics["loss"].update(loss, weight=n_tokens)
+            running_metrics["accuracy"].update(accuracy, weight=n_tokens)
+            running_metrics["grad_norm"].update(grad_norm, weight=is_finite.float())
+
+        # sync with host only on eval steps
+        if ((i + 1) % train_eval_freq == 0) or (i == len(dataloader) - 1):
+            bleu_score_list.append(
+                calculate_bleu_score(
+                    y_true=remove_padding(y_true, pad_mask=pad_mask),
+                    y_pred=remove_padding(y_pred, pad_mask=pad_mask),
+                )
+            )
+
+            if verbose:
+                for metric_name, running_mean in window_metrics.items():
+                    print(f"{metric_name}: {running_mean.mean()}")
+                print(f"sampled_bleu_score: {bleu_score_list[-1]}")
+                print()
 
-        # optimizer step
-        optimizer.step()
-        optimizer.zero_grad()
+            for running_mean in window_metrics.values():
+                running_mean.reset()
 
-        # make predictions
-        y_true = to_numpy(targets).tolist()
-        y_pred = to_numpy(outputs.argmax(dim=-1)).tolist()
-
-        # calculate metrics
-        metrics = calculate_metrics(
-            metrics=metrics,
-            loss=loss.item(),
-            grad_norm=grad_norm.item(),
-            y_true=y_true,
-            y_pred=y_pred,
-        )
-
-        if verbose:
-            if i % train_eval_freq == 0:
-                for metric_name, metric_list in metrics.items():
-                    print(f"{metric_name}: {np.mean(metric_list[-train_eval_freq:])}")
-                print()
+    metrics: DefaultDict[str, List[float]] = defaultdict(list)
+    for metric_name, running_mean in epoch_metrics.items():
+        metrics[metric_name].append(running_mean.mean())
+    metrics["sampled_bleu_score"].append(float(np.mean(bleu_score_list)))
 
     return metrics
 
@@ -83,43 +371,67 @@ def validate_epoch(
     dataloader: DataLoader,
     criterion: Callable,
     device: torch.device,
+    pad_id: int = 3,
+    amp_dtype: Optional[torch.dtype] = None,
     verbose: bool = True,
 ):
     """
     Validate loop on one epoch.
+    Loss and accuracy are averaged over all target tokens of the epoch
+    (independent of batch size), BLEU score is calculated on the whole epoch (corpus BLEU).
     """
 
     metrics: DefaultDict[str, List[float]] = defaultdict(list)
+    epoch_loss = RunningMean(device=device)
+    epoch_accuracy = RunningMean(device=device)
+    y_true_list: List[List[int]] = []
+    y_pred_list: List[List[int]] = []
+
+    if device.type == "cuda":
+        dataloader = CUDAPrefetcher(dataloader, device=device)  # type: ignore
 
     if verbose:
         dataloader = tqdm(dataloader)
 
     model.eval()
 
-    for input_lang_seq, output_lang_seq in dataloader:
-        input_lang_seq = input_lang_seq.to(device)
-        output_lang_seq = output_lang_seq.to(device)
-
-        inputs = (input_lang_seq, output_lang_seq[:, :-1])
-        targets = output_lang_seq[:, 1:]
+    for input_lang_seq, output_lang_seq, input_lang_lengths in dataloader:
+        input_lang_seq = input_lang_seq.to(device, non_blocking=True)
+        output_lang_seq = output_lang_seq.to(device, non_blocking=True)
 
         # forward pass
         with torch.no_grad():
-            outputs = model(*inputs)
-            loss = criterion(outputs.transpose(1, 2), targets)
+            outputs, loss = compute_loss(
+                model=model,
+                criterion=criterion,
+                input_lang_seq=input_lang_seq,
+                output_lang_seq=output_lang_seq,
+                input_lang_lengths=input_lang_lengths,
+                amp_dtype=amp_dtype,
+            )
 
         # make predictions
-        y_true = to_numpy(targets).tolist()
-        y_pred = to_numpy(outputs.argmax(dim=-1)).tolist()
-
-        # calculate metrics
-        metrics = calculate_metrics(
-            metrics=metrics,
-            loss=loss.item(),
-            y_true=y_true,
-            y_pred=y_pred,
+        y_true = output_lang_seq[:, 1:]
+        y_pred = outputs.argmax(dim=-1)
+        pad_mask = y_true != pad_id
+
+        # accumulate metrics weighted by number of target tokens
+        n_tokens = pad_mask.sum()
+        epoch_loss.update(loss, weight=n_tokens)
+        epoch_accuracy.update(
+            calculate_accuracy(y_true=y_true, y_pred=y_pred, pad_mask=pad_mask),
+            weight=n_tokens,
         )
 
+        y_true_list.extend(remove_padding(y_true, pad_mask=pad_mask))
+        y_pred_list.extend(remove_padding(y_pred, pad_mask=pad_mask))
+
+    metrics["loss"].append(epoch_loss.mean())
+    metrics["accuracy"].append(epoch_accuracy.mean())
+    metrics["bleu_score"].append(
+        calculate_bleu_score(y_true=y_true_list, y_pred=y_pred_list),
+    )
+
     return metrics
 
 
@@ -132,14 +444,32 @@ def train(
     device: torch.device,
     n_epoch: int,
     train_eval_freq: int = 500,
+    pad_id: int = 3,
     testloader: Optional[DataLoader] = None,
     scheduler: Optional[optim.lr_scheduler._LRScheduler] = None,
+    amp_dtype: Optional[torch.dtype] = None,
+    cuda_graph: bool = False,
+    cuda_graph_cache_size: int = 64,
+    cuda_graph_min_count: int = 3,
     verbose: bool = True,
 ):
     """
     Training / validation loop for n_epoch with final testing.
     """
 
+    # loss scaling is needed for float16 only
+    scaler = GradScaler(enabled=amp_dtype == torch.float16)
+
+    if cuda_graph and scaler.is_enabled():
+        raise ValueError("CUDA Graphs are not supported with float16 loss scaling")
+
+    # CUDA Graphs are captured once and reused across epochs (until lr changes)
+    cuda_graphs = (
+        CUDAGraphCache(max_size=cuda_graph_cache_size, min_count=cuda_graph_min_count)
+        if cuda_graph
+        else None
+    )
+
     for epoch in range(n_epoch):
 
         if verbose:
@@ -152,6 +482,10 @@ def train(
             optimizer=optimizer,
             device=device,
             train_eval_freq=train_eval_freq,
+            pad_id=pad_id,
+            scaler=scaler,
+            amp_dtype=amp_dtype,
+            cuda_graphs=cuda_graphs,
             verbose=verbose,
         )
 
@@ -165,6 +499,8 @@ def train(
             dataloader=valloader,
             criterion=criterion,
             device=device,
+            pad_id=pad_id,
+            amp_dtype=amp_dtype,
             verbose=verbose,
         )
 
@@ -174,8 +510,13 @@ def train(
             print()
 
         if scheduler is not None:
+            lr_list = scheduler.get_last_lr()
             scheduler.step()
 
+            # lr is baked into captured optimizer step, recapture on change
+            if (cuda_graphs is not None) and (scheduler.get_last_lr() != lr_list):
+                cuda_graphs.clear()
+
     if testloader is not None:
 
         test_metrics = validate_epoch(
@@ -183,6 +524,8 @@ def train(
             dataloader=testloader,
             criterion=criterion,
             device=device,
+            pad_id=pad_id,
+            amp_dtype=amp_dtype,
             verbose=verbose,
         )
 